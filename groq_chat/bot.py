@@ -1,3 +1,4 @@
+import asyncio
 import os
 from telegram import Update
 from telegram.ext import (
@@ -21,10 +22,13 @@ from groq_chat.handlers import (
     cancelled_system_prompt,
     info_command_handler,
     error_handler,
+    CHANGE_MODEL_PATTERN,
+    legacy_change_model_callback_handler,
+    LEGACY_CHANGE_MODEL_PATTERN,
 )
 from groq_chat.filters import AuthFilter, MessageFilter
+from groq_chat.groq_chat import close_chatbot
 from dotenv import load_dotenv
-from mongopersistence import MongoPersistence
 import logging
 
 load_dotenv()
@@ -38,10 +42,22 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
+# Configuration, read once at import. Required variables fail fast with KeyError.
+BOT_TOKEN = os.environ["BOT_TOKEN"]
+MONGODB_URL = os.getenv("MONGODB_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Blank values from an env file mean "unset", not an empty port or secret
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8443)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+POLLING = os.getenv("POLLING") == "1"
+
 persistence = None
-if os.getenv("MONGODB_URL"):
+if MONGODB_URL:
+    # Only pull in the MongoDB driver when persistence is configured
+    from mongopersistence import MongoPersistence
+
     persistence = MongoPersistence(
-        mongo_url=os.getenv("MONGODB_URL"),
+        mongo_url=MONGODB_URL,
         db_name="groq-chatbot",
         name_col_user_data="user_data",
         name_col_bot_data="bot_data",
@@ -49,14 +65,27 @@ if os.getenv("MONGODB_URL"):
         name_col_conversations_data="conversations_data",
         create_col_if_not_exist=True,  # optional
         ignore_general_data=["cache"],
-        update_interval=10,
+        # Completed turns are flushed explicitly by message_handler
+        update_interval=60,
     )
 
+# Use the faster libuv based event loop when it is available
+try:
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 
 def start_bot():
     logger.info("Starting bot")
 
-    app_builder = Application.builder().token(os.getenv("BOT_TOKEN"))
+    app_builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_shutdown(close_chatbot)
+    )
 
     # Add persistence if available
     if persistence:
@@ -90,12 +119,34 @@ def start_bot():
         )
     )
 
-    app.add_handler(MessageHandler(MessageFilter, message_handler))
+    # Generate responses in the background so other updates are not held up;
+    # message_handler serializes generations per user itself
+    app.add_handler(MessageHandler(MessageFilter, message_handler, block=False))
     app.add_handler(
-        CallbackQueryHandler(change_model_callback_handler, pattern="^change_model_")
+        CallbackQueryHandler(
+            change_model_callback_handler, pattern=CHANGE_MODEL_PATTERN
+        )
+    )
+    app.add_handler(
+        CallbackQueryHandler(
+            legacy_change_model_callback_handler, pattern=LEGACY_CHANGE_MODEL_PATTERN
+        )
     )
 
     app.add_error_handler(error_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Use polling during development or when no webhook URL is configured
+    if POLLING or not WEBHOOK_URL:
+        # Run the bot until the user presses Ctrl-C
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+
+    # Let Telegram push updates to us instead of polling for them
+    app.run_webhook(
+        listen="0.0.0.0",
+        port=WEBHOOK_PORT,
+        url_path=BOT_TOKEN,
+        webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
@@ -5,9 +5,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-_AUTHORIZED_USERS = [
+_AUTHORIZED_USERS = frozenset(
     i.strip() for i in os.getenv("AUTHORIZED_USERS", "").split(",") if i.strip()
-]
+)
 
 
 class AuthorizedUserFilter(UpdateFilter):
@@ -1,37 +1,80 @@
-from groq import Groq
+from functools import cache
+from groq import AsyncGroq
 from dotenv import load_dotenv
+from telegram.ext import Application
+import httpx
 import os
-import groq
-from telegram.ext import ContextTypes
 
 load_dotenv()
 
-# Create a ChatBot
-chatbot = Groq(
-    api_key=os.environ.get("GROQ_API_KEY"),
-)
+GROQ_API_KEY = os.environ["GROQ_API_KEY"]
+# Number of user/assistant exchanges kept in the conversation history
+MAX_HISTORY_TURNS = int(os.getenv("MAX_HISTORY_TURNS", 20))
+# Rough upper bound on the history size in characters sent with each request
+MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", 12000))
 
 
-def generate_response(message: str, context: ContextTypes.DEFAULT_TYPE):
-    """Generate a response to a message"""
-    context.user_data["messages"] = context.user_data.get("messages", []) + [
-        {
-            "role": "user",
-            "content": message,
-        }
-    ]
+@cache
+def get_chatbot() -> AsyncGroq:
+    """Create the Groq client on first use and reuse it afterwards
+
+    All requests share one pooled HTTP/2 connection, so concurrent chats
+    multiplex their streams instead of each paying for a TLS handshake.
+    """
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+    return AsyncGroq(
+        api_key=GROQ_API_KEY,
+        http_client=http_client,
+        max_retries=2,
+    )
+
+
+async def close_chatbot(_: Application) -> None:
+    """Close the Groq client's connections on shutdown"""
+    if get_chatbot.cache_info().currsize:
+        await get_chatbot().close()
+
+
+def trim_history(
+    messages: list,
+    max_turns: int = MAX_HISTORY_TURNS,
+    max_chars: int = MAX_HISTORY_CHARS,
+) -> list:
+    """Trim the conversation history in place to a sliding window.
+
+    Keeps the leading system prompt (if any) and at most the last ``max_turns``
+    user/assistant exchanges, then drops the oldest messages while the total
+    content length exceeds ``max_chars``. The latest message is always kept.
+    """
+    start = 1 if messages and messages[0].get("role") == "system" else 0
+    excess = len(messages) - start - 2 * max_turns
+    if excess > 0:
+        del messages[start : start + excess]
+    total = sum(len(m.get("content") or "") for m in messages)
+    while total > max_chars and len(messages) - start > 1:
+        total -= len(messages.pop(start).get("content") or "")
+    return messages
+
+
+async def generate_response(messages: list, model: str):
+    """Generate a response to a conversation
+
+    Raises groq.GroqError if the request fails, so that callers can decide
+    whether to keep the turn in the conversation history.
+    """
     response_queue = ""
-    try:
-        for resp in chatbot.chat.completions.create(
-            messages=context.user_data.get("messages"),
-            model=context.user_data.get("model", "llama3-8b-8192"),
-            stream=True,
-        ):
-            if resp.choices[0].delta.content:
-                response_queue += resp.choices[0].delta.content
-            if len(response_queue) > 100:
-                yield response_queue
-                response_queue = ""
-    except groq.GroqError as e:
-        yield f"Error: {e}\nStart a new conversation, click /new"
+    async for resp in await get_chatbot().chat.completions.create(
+        messages=messages,
+        model=model,
+        stream=True,
+    ):
+        if resp.choices[0].delta.content:
+            response_queue += resp.choices[0].delta.content
+        if len(response_queue) > 100:
+            yield response_queue
+            response_queue = ""
     yield response_queue
@@ -1,18 +1,78 @@
 import html
 import json
+import os
+import re
 import logging
 import traceback
+import groq
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
-from telegram.error import NetworkError, BadRequest
+from telegram.error import NetworkError, BadRequest, RetryAfter, TelegramError
 from telegram.constants import ChatAction, ParseMode
-from groq_chat.html_format import format_message
-from groq_chat.groq_chat import chatbot, generate_response
+from groq_chat.html_format import format_message_delta
+from groq_chat.groq_chat import generate_response, trim_history
 import asyncio
+from contextlib import asynccontextmanager
 
 SYSTEM_PROMPT_SP = 1
 CANCEL_SP = 2
 
+# Minimum seconds between two edits of the same streamed message
+EDIT_INTERVAL = 1.2
+# Telegram clears the typing indicator after ~5 seconds
+TYPING_INTERVAL = 4
+
+MODELS = ("llama3-8b-8192", "llama3-70b-8192", "mixtral-8x7b-32768", "gemma-7b-it")
+DEFAULT_MODEL = MODELS[0]
+# Callback data is "cm:<index into MODELS>"
+CHANGE_MODEL_PATTERN = re.compile(r"^cm:\d+$")
+# Callback data used by keyboards sent before the index encoding
+LEGACY_CHANGE_MODEL_PATTERN = re.compile(r"^change_model_")
+
+# Maximum number of Groq completions streamed at the same time
+GROQ_SEM = asyncio.Semaphore(int(os.getenv("GROQ_CONCURRENCY", "8")))
+# Per-user locks and the number of handlers holding or waiting on each
+_user_locks: dict[int, tuple[asyncio.Lock, int]] = {}
+
+# /info reply, already in Telegram HTML so it needs no markdown formatting
+INFO_TEMPLATE_HTML = (
+    "<b><u>Conversation Info:</u></b>\n<b>Model</b>: <code>{model}</code>\n"
+)
+
+# Chat that receives error reports, if any
+DEVELOPER_CHAT_ID = os.getenv("DEVELOPER_CHAT_ID")
+# Telegram rejects messages longer than 4096 characters
+MAX_ERROR_PART_LENGTH = 1800
+
+
+async def keep_typing(chat) -> None:
+    """Show the typing indicator in a chat until cancelled"""
+    while True:
+        try:
+            await chat.send_action(ChatAction.TYPING)
+        except TelegramError as e:
+            # The indicator is cosmetic, so just try again on the next round
+            logging.getLogger(__name__).debug("Failed to send typing action: %s", e)
+        await asyncio.sleep(TYPING_INTERVAL)
+
+
+@asynccontextmanager
+async def user_lock(user_id: int):
+    """Serialize response generation for a user"""
+    lock, users = _user_locks.get(user_id, (asyncio.Lock(), 0))
+    _user_locks[user_id] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = _user_locks[user_id]
+        if users == 1:
+            # Nobody else is waiting, so the lock can be dropped
+            del _user_locks[user_id]
+        else:
+            _user_locks[user_id] = (lock, users - 1)
+
+
 def new_chat(context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.user_data.get("system_prompt") is not None:
         context.user_data["messages"] = [
@@ -65,12 +125,10 @@ async def model_command_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Change the model used to generate responses"""
-    models = ["llama3-8b-8192", "llama3-70b-8192", "mixtral-8x7b-32768", "gemma-7b-it"]
-
     reply_markup = InlineKeyboardMarkup(
         [
-            [InlineKeyboardButton(model, callback_data="change_model_" + model)]
-            for model in models
+            [InlineKeyboardButton(model, callback_data=f"cm:{i}")]
+            for i, model in enumerate(MODELS)
         ]
     )
 
@@ -82,7 +140,11 @@ async def change_model_callback_handler(
 ) -> None:
     """Change the model used to generate responses"""
     query = update.callback_query
-    model = query.data.replace("change_model_", "")
+    idx = int(query.data[3:])
+    if idx >= len(MODELS):
+        await query.answer("Unknown model.")
+        return
+    model = MODELS[idx]
 
     context.user_data["model"] = model
 
@@ -92,6 +154,15 @@ async def change_model_callback_handler(
     )
 
 
+async def legacy_change_model_callback_handler(
+    update: Update, _: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Answer taps on outdated model keyboards"""
+    await update.callback_query.answer(
+        "This menu is outdated. Send /model to pick a model.", show_alert=True
+    )
+
+
 async def start_system_prompt(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
@@ -128,66 +199,152 @@ async def get_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle messages"""
     if "model" not in context.user_data:
-        context.user_data["model"] = "llama3-8b-8192"
-
-    if "messages" not in context.user_data:
-        context.user_data["messages"] = []
-
-    init_msg = await update.message.reply_text("Generating response...")
+        context.user_data["model"] = DEFAULT_MODEL
 
     message = update.message.text
     if not message:
         return
 
-    asyncio.run_coroutine_threadsafe(update.message.chat.send_action(ChatAction.TYPING), loop=asyncio.get_event_loop())
+    loop = asyncio.get_running_loop()
+    init_msg = None
+    last_edit = loop.time()
+    sent_message = ""
     full_output_message = ""
-    for message in generate_response(message, context):
-        if message:
-            full_output_message += message
-            send_message = format_message(full_output_message)
+    format_state = (0, "")
+
+    async def flush(wait: bool = True) -> None:
+        nonlocal init_msg, last_edit, sent_message, format_state
+        send_message, format_state = format_message_delta(
+            full_output_message, format_state
+        )
+        if not send_message.strip() or send_message == sent_message:
+            return
+        try:
+            init_msg = await init_msg.edit_text(
+                send_message, parse_mode=ParseMode.HTML, disable_web_page_preview=True
+            )
+        except RetryAfter as e:
+            if not wait:
+                # Skip this edit instead of waiting; a later flush delivers the text
+                last_edit = loop.time() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
             init_msg = await init_msg.edit_text(
                 send_message, parse_mode=ParseMode.HTML, disable_web_page_preview=True
             )
-    context.user_data["messages"] = context.user_data.get("messages", []) + [
-        {
-            "role": "assistant",
-            "content": full_output_message,
+        sent_message = send_message
+        last_edit = loop.time()
+
+    # The history lives in user_data, so generations are serialized per user.
+    # The lock is taken before the first await so turns keep their arrival order.
+    async with user_lock(update.effective_user.id):
+        init_msg = await update.message.reply_text("Generating response...")
+        messages = context.user_data.setdefault("messages", [])
+        user_message = {
+            "role": "user",
+            "content": message,
         }
-    ]
+        # Send a trimmed copy so a failed request leaves the history untouched
+        request_messages = trim_history(messages + [user_message])
+        completed = False
+        typing_task = asyncio.create_task(keep_typing(update.message.chat))
+        try:
+            async with GROQ_SEM:
+                async for message in generate_response(
+                    request_messages, context.user_data["model"]
+                ):
+                    if message:
+                        full_output_message += message
+                        if loop.time() - last_edit > EDIT_INTERVAL:
+                            # Don't hold a GROQ_SEM slot through a flood wait
+                            await flush(wait=False)
+            completed = True
+        except groq.GroqError as e:
+            full_output_message += f"Error: {e}\nStart a new conversation, click /new"
+        finally:
+            typing_task.cancel()
+        if completed:
+            messages.append(user_message)
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": full_output_message,
+                }
+            )
+            trim_history(messages)
+
+    await flush()
+    if completed:
+        # Persist the finished turn right away instead of waiting for the next
+        # interval. PTB only marks the user for saving after the handler returns.
+        context.application.mark_data_for_update_persistence(
+            user_ids=update.effective_user.id
+        )
+        await context.application.update_persistence()
 
 
 async def info_command_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Get info about the bot"""
-    message = f"""**__Conversation Info:__**
-**Model**: `{context.user_data.get("model", "llama3-8b-8192")}`
-"""
+    message = INFO_TEMPLATE_HTML.format(
+        model=html.escape(context.user_data.get("model", DEFAULT_MODEL))
+    )
     # if context.user_data.get("system_prompt") is not None:
     #     message += f"\n**System Prompt**: \n```\n{context.user_data.get("system_prompt")}\n```"
-    await update.message.reply_text(format_message(message), parse_mode=ParseMode.HTML)
-    
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+
+
+def escape_truncated(text: str, limit: int, from_end: bool = False) -> str:
+    """HTML-escape text, truncating it so the result is at most limit characters"""
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    parts, size = [], 1  # leave room for the ellipsis
+    for char in reversed(text) if from_end else text:
+        part = html.escape(char)
+        if size + len(part) > limit:
+            break
+        parts.append(part)
+        size += len(part)
+    if from_end:
+        return "…" + "".join(reversed(parts))
+    return "".join(parts) + "…"
+
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
     # Log the error before we do anything else, so we can see it even if something breaks.
     logging.getLogger(__name__).error("Exception while handling an update:", exc_info=context.error)
 
+    if not DEVELOPER_CHAT_ID:
+        return
+
     # traceback.format_exception returns the usual python message about an exception, but as a
     # list of strings rather than a single string, so we have to join them together.
     tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
     tb_string = "".join(tb_list)
 
     # Build the message with some markup and additional information about what happened.
-    # You might need to add some logic to deal with messages longer than the 4096 character limit.
+    # Each part is truncated so the message stays under the 4096 character limit.
     update_str = update.to_dict() if isinstance(update, Update) else str(update)
+    update_html = escape_truncated(
+        json.dumps(update_str, indent=2, ensure_ascii=False), MAX_ERROR_PART_LENGTH
+    )
+    # Keep the end of the traceback, where the exception is
+    tb_html = escape_truncated(tb_string, MAX_ERROR_PART_LENGTH, from_end=True)
     message = (
         "An exception was raised while handling an update\n"
-        f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
+        f"<pre>update = {update_html}"
         "</pre>\n\n"
-        f"<pre>{html.escape(tb_string)}</pre>"
+        f"<pre>{tb_html}</pre>"
     )
 
-    # Finally, send the message
-    await update.message.reply_text(
-        text=message, parse_mode=ParseMode.HTML
-    )
+    # Finally, send the message to the developer. Never let this raise, as
+    # that would re-enter the error handler.
+    try:
+        await context.bot.send_message(
+            chat_id=DEVELOPER_CHAT_ID, text=message, parse_mode=ParseMode.HTML
+        )
+    except Exception:
+        logging.getLogger(__name__).exception("error_handler failed")
@@ -1,4 +1,8 @@
 import re
+from functools import lru_cache
+
+# Fenced markdown code block, shared by apply_code and format_message_delta
+CODE_BLOCK_PATTERN = re.compile(r"```([\w]*?)\n([\s\S]*?)```", flags=re.DOTALL)
 
 
 def escape_html(text: str) -> str:
@@ -72,8 +76,7 @@ def apply_code(text: str) -> str:
     Returns:
     str: The text with markdown code blocks replaced by HTML tags.
     """
-    pattern = r"```([\w]*?)\n([\s\S]*?)```"
-    replaced_text = re.sub(pattern, r"<pre lang='\1'>\2</pre>", text, flags=re.DOTALL)
+    replaced_text = CODE_BLOCK_PATTERN.sub(r"<pre lang='\1'>\2</pre>", text)
     return replaced_text
 
 
@@ -175,6 +178,7 @@ def apply_exclude_code(text: str) -> str:
     return "\n".join(lines)
 
 
+@lru_cache(maxsize=256)
 def format_message(text: str) -> str:
     """Format the given message text from markdown to HTML.
 
@@ -190,4 +194,35 @@ def format_message(text: str) -> str:
     formatted_text = escape_html(text)
     formatted_text = apply_exclude_code(formatted_text)
     formatted_text = apply_code(formatted_text)
-    return formatted_text
\ No newline at end of file
+    return formatted_text
+
+
+def format_message_delta(text: str, state: tuple = (0, "")) -> tuple:
+    """Format a growing message from markdown to HTML incrementally.
+
+    Lines that are complete and outside any code block are formatted once and
+    remembered in ``state``, so repeated calls with a growing ``text`` only
+    re-format the trailing part. The result is the same as ``format_message``.
+
+    Args:
+      text (str): The full message text, which must extend the text passed
+        in the previous call.
+      state (tuple): The state returned by the previous call.
+
+    Returns:
+      tuple: The formatted HTML string and the state for the next call.
+    """
+    consumed, prefix = state
+    tail = text[consumed:]
+    split = tail.rfind("\n")
+    if split != -1:
+        head = apply_exclude_code(escape_html(tail[:split]))
+        fences = head.count("```")
+        fence_lines = sum(line.startswith("```") for line in head.split("\n"))
+        code_blocks = len(CODE_BLOCK_PATTERN.findall(head))
+        # Only commit the head once every code block in it has been closed
+        if fence_lines % 2 == 0 and code_blocks * 2 == fences:
+            prefix += apply_code(head) + "\n"
+            consumed += split + 1
+            tail = tail[split + 1 :]
+    return prefix + format_message(tail), (consumed, prefix)